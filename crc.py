@@ -1,12 +1,15 @@
 # code from the rhizo project: https://github.com/rhizolab/rhizo
+from binascii import crc_hqx
 
 
-# an implementation of the CRC16-CCITT algorithm; assumes message is an ascii string
+# an implementation of the CRC16-CCITT algorithm; assumes message is a byte string (or other bytes-like object, e.g. a memoryview);
+# uses the C implementation in binascii: crc_hqx processes bits most-significant first, so we bit-reverse each byte of the message
+# and then bit-reverse the result
 def crc16_ccitt(message):
-    crc = 0xFFFF
-    for c in message:
-        crc = crc16_update(crc, ord(c))
-    return crc
+    if not isinstance(message, bytes):
+        message = bytes(message)
+    crc = crc_hqx(message.translate(BIT_REVERSE_BYTES), 0xFFFF)
+    return (BIT_REVERSE[crc & 0xFF] << 8) | BIT_REVERSE[crc >> 8]
 
 
 # an implementation of the CRC16-CCITT algorithm; assumes data is an 8-bit value
@@ -14,3 +17,8 @@ def crc16_update(crc, data):
     data = data ^ (crc & 0xFF)
     data = data ^ ((data << 4) & 0xFF)
     return (((data << 8) & 0xFFFF) | ((crc >> 8) & 0xFF)) ^ (data >> 4) ^ (data << 3)
+
+
+# lookup tables giving each byte value with its bits in reverse order
+BIT_REVERSE = bytearray(int('{:08b}'.format(b)[::-1], 2) for b in range(256))
+BIT_REVERSE_BYTES = bytes(BIT_REVERSE)
@@ -15,7 +15,7 @@ else:
 
 # display data from sensors
 def input_handler(component, value):
-    print component.device.id, component.type, value
+    print(component.device.id, component.type, value)
 
 
 # prepare logging
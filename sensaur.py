@@ -1,12 +1,23 @@
+import re
 import time
+import heapq
 import logging
 import gevent
 import serial
 import crc
 
 
+# a serial message is a payload followed by a hex checksum; a payload from a device is a device index, a command, and (optionally) arguments
+SERIAL_MESSAGE_RE = re.compile(br'^((?:(\d+)>([^:|]*)(?::(.*))?)|.*)\|([0-9A-Fa-f]+)$')
+
+
+# number of seconds without a message after which we consider a device to be unplugged
+DISCONNECT_TIMEOUT = 3.5
+
+
 # a component is one input or output channel on a device (generally one sensor or actuator, but some sensors/actuators may have multiple channels)
 class Component(object):
+    __slots__ = ('device', 'name', 'dir', 'type', 'model', 'units', 'version', 'store_sequence', 'output_value', 'output_index')
 
     def __init__(self, device):
         self.device = device
@@ -18,6 +29,7 @@ class Component(object):
         self.version = '0'  # not used; here temporarily for compatibility with data flow system
         self.store_sequence = False  # not used; here temporarily for compatibility with data flow system
         self.output_value = 0
+        self.output_index = None  # position of this component in the device's output values (if it is an output)
 
     # return information about the sensor/actuator as a dictionary
     def as_dict(self):
@@ -34,12 +46,16 @@ class Component(object):
 
 # a device is a board with sensors and/or actuators
 class Device(object):
+    __slots__ = ('index', 'id', 'components', 'input_components', 'output_components', 'output_strs', 'last_message_time')
 
-    def __init__(self, index):
+    def __init__(self, index, last_message_time):
         self.index = index
         self.id = None
         self.components = []
-        self.last_message_time = time.time()
+        self.input_components = []
+        self.output_components = []
+        self.output_strs = []  # current output values (as byte strings) in the order they are sent to the device
+        self.last_message_time = last_message_time
 
 
 # a hub connects to multiple devices and processes data from the devices
@@ -47,22 +63,25 @@ class Hub(object):
 
     def __init__(self, serial_port, baud_rate=38400, debug_serial=False):
         self.devices = {}
+        self.disconnect_deadlines = []  # heap of (deadline, device index); one entry per device
         self.components = []
+        self.components_by_name = {}
         self.input_handlers = []
         self.serial = serial.Serial(serial_port, baudrate=baud_rate, timeout=0.05)
         self.debug_serial = debug_serial
+        self.poll_frame = self.serial_frame(b'p')  # the polling message never changes, so we only need to compute its checksum once
+        self.metadata_request_frames = {}  # metadata request message for each device index
 
     # run functions when we receive data from a sensor
     # based on similar code from rhizo auto_devices
     def run_input_handlers(self, component, values):
         for handler in self.input_handlers:
-            if hasattr(handler, 'handle_input'):  # handler is object
-                handler.handle_input(component, values)
-            else:  # handler is function
-                handler(component, values)
+            handler(component, values)
 
-    # add a function that will get called when we receive data from a sensor
+    # add a function (or an object with a handle_input method) that will get called when we receive data from a sensor
     def add_input_handler(self, handler):
+        if hasattr(handler, 'handle_input'):  # handler is object
+            handler = handler.handle_input
         self.input_handlers.append(handler)
 
     def start_greenlets(self):
@@ -77,111 +96,135 @@ class Hub(object):
 
     # poll devices once a second
     def polling_loop(self):
+        next_time = time.monotonic()
         while True:
-            self.send_serial_emssage('p')
-            gevent.sleep(1.0)
+            self.send_serial_frame(self.poll_frame)
+            next_time = self.sleep_until(next_time + 1.0)
 
-    # check for incoming serial messages
+    # check for incoming serial messages; we read everything that is waiting (blocking until at least one byte
+    # arrives or the serial timeout expires) and process each complete line
     def receiver_loop(self):
+        pending = b''
         while True:
-            message = self.serial.readline().strip()
-            if message:
-                self.process_serial_message(message)
-            gevent.sleep(0.1)
+            data = self.serial.read(self.serial.in_waiting or 1)
+            if data:
+                lines = (pending + data).split(b'\n')
+                pending = lines.pop()  # keep any partial line until the rest of it arrives
+                now = time.monotonic()
+                for message in lines:
+                    message = message.strip()
+                    if message:
+                        self.process_serial_message(message, now)
+            gevent.sleep(0)  # always yield; the (monkey-patched) read doesn't yield when data is already waiting
 
     # check for devices that have been unplugged
     def disconnect_checker(self):
+        next_time = time.monotonic()
         while True:
-            gevent.sleep(1.0)
-            t = time.time()
-            for (index, d) in self.devices.items():
-                if t - d.last_message_time > 3.5:
+            next_time = self.sleep_until(next_time + 1.0)
+            t = time.monotonic()
+            deadlines = self.disconnect_deadlines
+            while deadlines and deadlines[0][0] < t:
+                index = heapq.heappop(deadlines)[1]
+                d = self.devices[index]
+                deadline = d.last_message_time + DISCONNECT_TIMEOUT  # same expression as the heap key, so a re-pushed deadline is never already due
+                if deadline < t:
                     logging.debug('device %d removed' % index)
                     self.components = [c for c in self.components if c.device != d]
+                    for c in d.components:
+                        del self.components_by_name[c.name]
                     del self.devices[index]
+                else:  # we've heard from the device since this deadline was set, so check it again later
+                    heapq.heappush(deadlines, (deadline, index))
+
+    # sleep until the given (monotonic) time, so that periodic loops don't drift by the time spent doing their work;
+    # returns the time the caller should schedule from (if we're already late, we start over from now rather than catching up)
+    def sleep_until(self, next_time):
+        delay = next_time - time.monotonic()
+        if delay > 0:
+            gevent.sleep(delay)
+            return next_time
+        return time.monotonic()
 
     # send a value to an actuator
     def set_output_value(self, component, value):
         device = component.device
+        if component.output_index is None:
+            logging.warning('component %s is not an output on device %d' % (component.name, device.index))
+            return
         component.output_value = value
-        output_values = []
-        for c in device.components:
-            if c.dir == 'out':
-                output_values.append(str(c.output_value))
-        self.send_serial_emssage('%d>s:%s' % (device.index, ','.join(output_values)))
+        device.output_strs[component.output_index] = str(value).encode('ascii')
+        self.send_serial_emssage(b'%d>s:%s' % (device.index, b','.join(device.output_strs)))
 
-    # send a serial message to the hub I/O board (pi hat)
+    # send a serial message (a byte string) to the hub I/O board (pi hat)
     def send_serial_emssage(self, message):
-        checksum = crc.crc16_ccitt(message)
-        if self.debug_serial:
-            print('send %s|%X' % (message, checksum))
-        self.serial.write('%s|%X\n' % (message, checksum))
-
-    # process a serial message from the hub I/O board (pi hat)
-    def process_serial_message(self, message):
-        if self.debug_serial:
-            print('recv %s' % message)
-
-        # check checksum
-        if '|' in message:
-            parts = message.split('|')
-            message = parts[0]
-            checksum_computed = crc.crc16_ccitt(message)
-            checksum_given = int(parts[1], 16)
-            if checksum_computed != checksum_given:
-                logging.warning('invalid checksum (computed: %x, given: %x)' % (checksum_computed, checksum_given))
-                return
-        else:
-            logging.warning('checksum missing')
+        self.send_serial_frame(self.serial_frame(message))
+
+    # send a serial message that has already been combined with its checksum
+    def send_serial_frame(self, frame):
+        if self.debug_serial and logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('send %s', frame.rstrip().decode('ascii', 'replace'))
+        self.serial.write(frame)
+
+    # append a checksum to a serial message
+    def serial_frame(self, message):
+        return b'%s|%X\n' % (message, crc.crc16_ccitt(message))
+
+    # request metadata for a device board
+    def request_metadata(self, device_index):
+        frame = self.metadata_request_frames.get(device_index)
+        if frame is None:
+            frame = self.serial_frame(b'%d>m' % device_index)
+            self.metadata_request_frames[device_index] = frame
+        self.send_serial_frame(frame)
+
+    # process a serial message from the hub I/O board (pi hat); now is the (monotonic) time the message was received
+    def process_serial_message(self, message, now):
+        if self.debug_serial and logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('recv %s', message.decode('ascii', 'replace'))
+
+        # parse the message and check checksum
+        match = SERIAL_MESSAGE_RE.match(message)
+        if not match:
+            logging.warning('checksum missing or malformed')
+            return
+        (message, device_index, command, args, checksum_given) = match.groups()
+        checksum_computed = crc.crc16_ccitt(message)
+        checksum_given = int(checksum_given, 16)
+        if checksum_computed != checksum_given:
+            logging.warning('invalid checksum (computed: %x, given: %x)' % (checksum_computed, checksum_given))
             return
 
         # handle message from device
-        if '>' in message:
-
-            # parse the message
-            parts = message.split('>', 1)
-            try:
-                device_index = int(parts[0])
-            except ValueError:
-                return
-            payload = parts[1]
-            if ':' in message:
-                parts = payload.split(':', 1)
-                command = parts[0]
-                args = parts[1]
-            else:
-                command = message
-                args = []
+        if device_index:
+            device_index = int(device_index)
+            if args is None:  # commands without arguments aren't handled (but still count as a message from the device)
+                command = None
 
             # find devices corresponding to the sender board
             device = self.devices.get(device_index)
             if device:
-                device.last_message_time = time.time()
+                device.last_message_time = now
 
                 # if values, send to handlers
-                if command == 'v':
+                if command == b'v':
                     if device.components:
-                        args = args.split(',')
-                        arg_index = 0
-                        for comp in device.components:
-                            if comp.dir == 'in':
-                                if arg_index < len(args):
-                                    try:
-                                        value = float(args[arg_index])  # make sure this is a numeric value (but pass it to handler as a string for now)
-                                        self.run_input_handlers(comp, args[arg_index])
-                                    except:
-                                        pass
-                                    arg_index += 1
-                                else:
-                                    logging.warning('received more values than input components (device %d has %d components; message: %s)' % (device_index, len(device.components), message))
-                                    break
+                        args = args.decode('ascii', 'replace').split(',')
+                        if len(args) != len(device.input_components):
+                            logging.warning('received %d values for %d input components (device %d; message: %s)' % (len(args), len(device.input_components), device_index, message.decode('ascii', 'replace')))
+                        for (comp, value) in zip(device.input_components, args):
+                            try:
+                                float(value)  # make sure this is a numeric value (but pass it to handler as a string for now)
+                                self.run_input_handlers(comp, value)
+                            except:
+                                pass
                     else:
                         logging.debug('received values for device without metadata; requesting metadata')
-                        self.send_serial_emssage('%d>m' % device_index)  # request metadata for this device board
+                        self.request_metadata(device_index)
 
                 # if metadata, store in device
-                if command == 'm':
-                    args = args.split(';')
+                if command == b'm':
+                    args = args.decode('ascii', 'replace').split(';')
                     version = args[0]
                     if version != '1':
                         logging.warning('invalid device version (%s)' % version)
@@ -207,23 +250,28 @@ class Hub(object):
                             logging.debug('new component; dir: %s, type: %s, model: %s, units: %s, name: %s' % (comp.dir, comp.type, comp.model, comp.units, comp.name))
                             device.components.append(comp)
                             self.components.append(comp)
+                            self.components_by_name[comp.name] = comp
+                    device.input_components = [c for c in device.components if c.dir == 'in']
+                    device.output_components = [c for c in device.components if c.dir == 'out']
+                    for (i, c) in enumerate(device.output_components):
+                        c.output_index = i
+                    device.output_strs = [str(c.output_value).encode('ascii') for c in device.output_components]
                     logging.debug('device %d has %d components' % (device_index, len(device.components)))
 
             # if response without device record, request meta data
             else:
                 logging.debug('new device on device index %d; requesting metadata' % device_index)
-                self.devices[device_index] = Device(device_index)
-                self.send_serial_emssage('%d>m' % device_index)  # request metadata for this device board
+                device = Device(device_index, now)
+                self.devices[device_index] = device
+                heapq.heappush(self.disconnect_deadlines, (device.last_message_time + DISCONNECT_TIMEOUT, device_index))
+                self.request_metadata(device_index)
 
     # ======== temporary functions ========
     # borrowed from auto_devices for compatibility with it; will be removed in future
 
     # find a component by name; each component should have a unique name
     def find_component(self, name):
-        for c in self.components:
-            if c.name == name:
-                return c
-        return None
+        return self.components_by_name.get(name)
 
     # assign component name based on type
     def assign_name(self, type):